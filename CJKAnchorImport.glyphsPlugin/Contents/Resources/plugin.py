@@ -9,6 +9,7 @@ from GlyphsApp.plugins import *
 import os
 import sys
 import contextlib
+import itertools
 import collections
 
 # FIX: allows additional arguments when initializing GSAnchor on Glyphs 3.
@@ -35,6 +36,8 @@ from Foundation import NSBundle, NSPoint, NSEqualRects, NSZeroRect
 
 NEEDS_APPLY_VMTX_VALUES_ON_IMPORT = True
 
+ANCHOR_NAMES = ('LSB', 'RSB', 'TSB', 'BSB')
+
 def CIDShortResourceName(obj, *args):
     if len(args) == 1:
         if obj.respondsToSelector_('CIDShortResourceName:'):
@@ -51,19 +54,23 @@ def CIDShortResourceName(obj, *args):
 def get_mapfile_name(font):
     filename = None
     if hasattr(Glyphs, 'versionNumber') and Glyphs.versionNumber >= 3.0:
-        operation = objc.lookUpClass('GSExportInstanceOperation').alloc().initWithFont_instance_outlineFormat_containers_(Glyphs.font, None, 1, None)
+        operation = objc.lookUpClass('GSExportInstanceOperation').alloc().initWithFont_instance_outlineFormat_containers_(font, None, 1, None)
         ro = CIDShortResourceName(operation)
         filename = NSBundle.bundleForClass_(GSFont.__class__).pathForResource_ofType_("MapFile{0}".format(ro), 'txt')
     else:
-        operation = objc.lookUpClass('GSExportInstanceOperation').alloc().initWithFont_instance_format_(Glyphs.font, None, 0)
+        operation = objc.lookUpClass('GSExportInstanceOperation').alloc().initWithFont_instance_format_(font, None, 0)
         ro = CIDShortResourceName(operation)
         filename = NSBundle.bundleWithPath_(os.path.join(NSBundle.mainBundle().builtInPlugInsPath(), 'OTF.glyphsFileFormat')).pathForResource_ofType_('MapFile{0}'.format(ro), 'txt')
     return filename
 
 class CJKAnchorImportPlugin(GeneralPlugin):
     
+    # parsed MapFile dictionaries keyed by (filename, mtime, dest); the contents never change for a given ROS
+    _cid_rename_cache = {}
+    
     @objc.python_method
     def start(self):
+        self._ttfont_cache = None
         Glyphs.addCallback(self.documentOpened, DOCUMENTOPENED)
     
     @objc.python_method
@@ -75,95 +82,146 @@ class CJKAnchorImportPlugin(GeneralPlugin):
     
     @objc.python_method
     def __import_anchors(self, font):
-        with GSFontUpdatingContext(font):
+        with GSFontUpdatingContext(font), GSUndoRegistrationDisabledContext(font.parent):
             
             reader = None
             extension = os.path.splitext(font.filepath)[1].lower()
             
             if extension in ['.otf', '.ttf', '.otc', '.ttc']:
-                ttfont = TTFont(font.filepath)
+                ttfont = self.__load_ttfont(font.filepath)
                 if CJKAlternateMetricsGPOSReader.can_open_font(ttfont):
                     reader = CJKAlternateMetricsGPOSReader(ttfont)
             elif extension in ['.ufo']:
                 reader = CJKAlternateMetricsUFOReader(font)
                 
             if reader and reader.has_metrics:
-                cid_rename_dict = self.__make_cid_rename_dict(font, dest='cid')
+                cid_rename_dict = {}
+                if self.__has_cid_glyph_names(reader):
+                    cid_rename_dict = self.__make_cid_rename_dict(font, dest='cid') or {}
+                resolved_vmtx = self.__resolve_renamed_dict(reader.vmtx, cid_rename_dict)
+                resolved_edge_insets = self.__resolve_renamed_dict(reader.edge_insets, cid_rename_dict)
+                # the loop below only needs the two dictionaries; let the reader's parsing state go
+                reader = None
+                upm = font.upm
+                master_info = [(master.id, master.ascender, master.descender, upm / 2.0 + master.descender) for master in font.masters]
                 for glyph in font.glyphs:
-                    for master in font.masters:
-                        layer = glyph.layers[master.id]
+                    vertical_metrics = resolved_vmtx.get(glyph.name)
+                    edge_insets = resolved_edge_insets.get(glyph.name)
+                    # pending (layer, vert_origin, vert_width, anchors) writes; None leaves the value as it is
+                    layer_updates = []
+                    for master_id, ascender, descender, master_center_y in master_info:
+                        layer = glyph.layers[master_id]
                         
+                        vert_origin = None
+                        vert_width = None
                         offset_y = 0.0
-                        vertical_metrics = reader.vmtx.get(glyph.name)
-                        if not vertical_metrics and cid_rename_dict and glyph.name in cid_rename_dict:
-                            vertical_metrics = reader.vmtx.get(cid_rename_dict[glyph.name])
                         if vertical_metrics:
                             layer_tsb = layer.TSB
                             if NSEqualRects(layer.bounds, NSZeroRect):
-                                layer_tsb = master.ascender
+                                layer_tsb = ascender
                             offset_y = vertical_metrics.TSB - round(layer_tsb)
                             
                             if NEEDS_APPLY_VMTX_VALUES_ON_IMPORT:
-                                if offset_y != 0.0 or vertical_metrics.height != font.upm:
-                                    layer.setVertOrigin_(offset_y)
-                                    layer.setVertWidth_(vertical_metrics.height)
-                        
-                        edge_insets = reader.edge_insets.get(glyph.name)
-                        if not edge_insets and cid_rename_dict and glyph.name in cid_rename_dict:
-                            edge_insets = reader.edge_insets.get(cid_rename_dict[glyph.name])
+                                if offset_y != 0.0 or vertical_metrics.height != upm:
+                                    if layer.vertOrigin != offset_y:
+                                        vert_origin = offset_y
+                                    if layer.vertWidth != vertical_metrics.height:
+                                        vert_width = vertical_metrics.height
                         
+                        anchors = list(layer.anchors)
+                        new_anchors = [anchor for anchor in anchors if anchor.name not in ANCHOR_NAMES]
                         if edge_insets:
-                            center = NSPoint(layer.width / 2.0, font.upm / 2.0 + master.descender)
-                            self.__clear_anchors(layer, ('LSB', 'RSB', 'TSB', 'BSB'))
-                            anchor_lsb = None
-                            anchor_rsb = None
-                            anchor_tsb = None
-                            anchor_bsb = None
-                            if edge_insets.left != 0 or edge_insets.right != 0:
+                            width = layer.width
+                            has_horizontal_insets = edge_insets.left != 0 or edge_insets.right != 0
+                            has_vertical_insets = edge_insets.top != 0 or edge_insets.bottom != 0
+                            center_x = width / 2.0
+                            center_y = master_center_y
+                            if has_horizontal_insets:
                                 x1 = edge_insets.left
-                                x2 = layer.width - edge_insets.right
-                                anchor_lsb = self.__upsert_anchor(layer, 'LSB', NSPoint(x1, center.y))
-                                anchor_rsb = self.__upsert_anchor(layer, 'RSB', NSPoint(x2, center.y))
-                                center.x = round((x1 + x2) / 2.0)
-                            if edge_insets.top != 0 or edge_insets.bottom != 0:
-                                y1 = font.upm - edge_insets.top + master.descender + offset_y
-                                y2 = edge_insets.bottom + master.descender + offset_y
-                                anchor_tsb = self.__upsert_anchor(layer, 'TSB', NSPoint(center.x, y1))
-                                anchor_bsb = self.__upsert_anchor(layer, 'BSB', NSPoint(center.x, y2))
-                                center.y = round((y1 + y2) / 2.0)
-                            if anchor_lsb and anchor_rsb and anchor_tsb and anchor_bsb:
-                                anchor_lsb.position = NSPoint(anchor_lsb.position.x, center.y)
-                                anchor_rsb.position = NSPoint(anchor_rsb.position.x, center.y)
-                                anchor_tsb.position = NSPoint(center.x, anchor_tsb.position.y)
-                                anchor_bsb.position = NSPoint(center.x, anchor_bsb.position.y)
-                            
-                        else:
-                            self.__clear_anchors(layer, ('LSB', 'RSB', 'TSB', 'BSB'))
+                                x2 = width - edge_insets.right
+                                center_x = round((x1 + x2) / 2.0)
+                            if has_vertical_insets:
+                                y1 = upm - edge_insets.top + descender + offset_y
+                                y2 = edge_insets.bottom + descender + offset_y
+                                center_y = round((y1 + y2) / 2.0)
+                            positions = {}
+                            if has_horizontal_insets:
+                                positions['LSB'] = (x1, center_y)
+                                positions['RSB'] = (x2, center_y)
+                            if has_vertical_insets:
+                                positions['TSB'] = (center_x, y1)
+                                positions['BSB'] = (center_x, y2)
+                            # leave the layer untouched when a previous import already placed the same anchors
+                            current_positions = dict([(anchor.name, (round(anchor.position.x), round(anchor.position.y))) for anchor in anchors if anchor.name in ANCHOR_NAMES])
+                            if current_positions != dict([(name, (round(x), round(y))) for name, (x, y) in positions.items()]):
+                                new_anchors.extend([GSAnchor(name, NSPoint(*positions[name])) for name in ANCHOR_NAMES if name in positions])
+                            else:
+                                new_anchors = None
+                        elif len(new_anchors) == len(anchors):
+                            new_anchors = None
+                        
+                        if vert_origin is not None or vert_width is not None or new_anchors is not None:
+                            layer_updates.append((layer, vert_origin, vert_width, new_anchors))
+                    
+                    if layer_updates:
+                        self.__apply_layer_updates(glyph, layer_updates)
         
     @objc.python_method
-    def __clear_anchors(self, layer, names):
-        for name in names:
-            layer.removeAnchorWithName_(name)
+    def __apply_layer_updates(self, glyph, layer_updates):
+        # only glyphs that are actually written pay for the undo manager round-trips
+        with GSUndoRegistrationDisabledContext(glyph):
+            for layer, vert_origin, vert_width, anchors in layer_updates:
+                if vert_origin is not None:
+                    layer.setVertOrigin_(vert_origin)
+                if vert_width is not None:
+                    layer.setVertWidth_(vert_width)
+                if anchors is not None:
+                    layer.anchors = anchors
     
     @objc.python_method
-    def __upsert_anchor(self, layer, name, position):
-        anchor = None
-        if name in layer.anchors:
-            anchor = layer.anchors[name]
-            anchor.position = position
-        else:
-            anchor = GSAnchor(name, position)
-            layer.anchors.append(anchor)
-        return anchor
-
+    def __load_ttfont(self, path):
+        # keeps only the most recently loaded font; reopening the same unmodified file reuses it
+        mtime = os.path.getmtime(path)
+        if self._ttfont_cache:
+            cached_path, cached_mtime, cached_ttfont = self._ttfont_cache
+            if cached_path == path and cached_mtime == mtime:
+                return cached_ttfont
+            self._ttfont_cache = None
+            cached_ttfont.close()
+        ttfont = TTFont(path, lazy=True)
+        self._ttfont_cache = (path, mtime, ttfont)
+        return ttfont
+    
+    @objc.python_method
+    def __has_cid_glyph_names(self, reader):
+        # only CID-keyed sources name their glyphs cidNNNNN; others already match the glyph names in Glyphs
+        return any(name.startswith('cid') for name in itertools.chain(reader.edge_insets, reader.vmtx))
+    
+    @objc.python_method
+    def __resolve_renamed_dict(self, d, rename_dict):
+        if not rename_dict:
+            return d
+        resolved = dict(d)
+        for name, renamed in rename_dict.items():
+            if name not in resolved and renamed in d:
+                resolved[name] = d[renamed]
+        return resolved
+    
     @objc.python_method
     def __make_cid_rename_dict(self, font, dest='cid'):
         filename = get_mapfile_name(font)
         if filename:
-            with open(filename, 'r') as file:
-                make_tuple = (lambda c: (c[1], 'cid{0:05d}'.format(int(c[0])))) if dest == 'cid' else (lambda c: ('cid{0:05d}'.format(int(c[0])), c[1]))
-                rename_dict = dict([make_tuple(line.split('\t')) for line in file])
-                return rename_dict
+            key = (filename, os.path.getmtime(filename), dest)
+            rename_dict = self._cid_rename_cache.get(key)
+            if rename_dict is None:
+                with open(filename, 'r') as file:
+                    rows = [line.split('\t') for line in file.read().splitlines() if line]
+                if dest == 'cid':
+                    rename_dict = dict([(c[1], 'cid' + c[0].strip().zfill(5)) for c in rows])
+                else:
+                    rename_dict = dict([('cid' + c[0].strip().zfill(5), c[1]) for c in rows])
+                self._cid_rename_cache[key] = rename_dict
+            return rename_dict
         return None
     
     @objc.python_method
@@ -181,8 +239,24 @@ def GSFontUpdatingContext(font):
         font.enableUpdateInterface()
 
 
+@contextlib.contextmanager
+def GSUndoRegistrationDisabledContext(obj):
+    # works for anything that owns an undo manager, e.g. the document or a glyph
+    undo_manager = None
+    if obj is not None and obj.respondsToSelector_('undoManager'):
+        undo_manager = obj.undoManager()
+    if undo_manager:
+        undo_manager.disableUndoRegistration()
+    try:
+        yield obj
+    finally:
+        if undo_manager:
+            undo_manager.enableUndoRegistration()
+
+
 H = 0
 V = 1
+# adjustments are kept as plain (glyph, placement, advance, direction) tuples; the namedtuple is only used for display
 Adjustment = collections.namedtuple('Adjustment', ['glyph', 'placement', 'advance', 'direction'])
 EdgeInsets = collections.namedtuple('EdgeInsets', ['left', 'right', 'top', 'bottom'])
 VerticalMetrics = collections.namedtuple('VerticalMetrics', ['height', 'TSB'])
@@ -192,7 +266,10 @@ class CJKAlternateMetricsGPOSReader(object):
     @classmethod
     def can_open_font(cls, font):
         if font and 'GPOS' in font:
-            return True
+            feature_list = font['GPOS'].table.FeatureList
+            if feature_list:
+                tags = set([r.FeatureTag for r in feature_list.FeatureRecord])
+                return 'palt' in tags or 'vpal' in tags
         return False
     
     def __init__(self, font):
@@ -214,55 +291,48 @@ class CJKAlternateMetricsGPOSReader(object):
             self.__table = table
             self.__tag_list = self.__make_tag_list(table)
             self.__tag_lookup_dict = self.__make_tag_lookup_dict(table)
-            self.__lookup_adjustments_dict = self.__make_lookup_adjustments_dict(table)
+            self.__lookup_adjustments_dict = self.__make_lookup_adjustments_dict(self.__tag_lookup_dict)
             self.__edge_insets_dict = self.__make_edge_insets_dict()
         if 'vmtx' in font:
             vmtx = font['vmtx']
             self.__vmtx = vmtx
             self.__vmtx_dict = self.__make_vmtx_dict()
+        self.__tags = tuple(self.__tag_list)
+        self.__has_metrics = 'palt' in self.__tags or 'vpal' in self.__tags
     
     def __make_tag_list(self, table):
-        l = [r.FeatureTag for r in table.FeatureList.FeatureRecord]
-        s = set(l)
-        return [tag for tag in sorted(s, key=lambda x: l.index(x))]
+        return list(collections.OrderedDict.fromkeys(r.FeatureTag for r in table.FeatureList.FeatureRecord))
         
     def __make_tag_lookup_dict(self, table):
-        d = {}
+        d = collections.defaultdict(set)
         for record in table.FeatureList.FeatureRecord:
-            tag = record.FeatureTag
-            if tag not in d:
-                d[tag] = set([])    
-            indices = record.Feature.LookupListIndex
-            d[tag].update(indices)
-        for tag in list(d.keys()):
-            d[tag] = [table.LookupList.Lookup[i] for i in sorted(d[tag])]
-        return d
+            d[record.FeatureTag].update(record.Feature.LookupListIndex)
+        return dict([[tag, [table.LookupList.Lookup[i] for i in sorted(indices)]] for tag, indices in d.items()])
 
-    def __make_lookup_adjustments_dict(self, table):
-        return dict([[id(lookup), self.__make_adjustments_from_lookup(lookup)] for lookup in table.LookupList.Lookup])
-    
-    def __make_edge_insets_from_adjustments(self, adjustments):
-        placement_x, advance_x, placement_y, advance_y = (0, 0, 0, 0)
-        for adjustment in adjustments:
-            if adjustment.direction == H:
-                placement_x += adjustment.placement
-                advance_x   += adjustment.advance
-            elif adjustment.direction == V:
-                placement_y += adjustment.placement
-                advance_y   += adjustment.advance
+    def __make_lookup_adjustments_dict(self, tag_lookup_dict):
+        # only lookups reachable from palt/vpal contribute to the edge insets
+        d = {}
+        for lookup in tag_lookup_dict.get('palt', []) + tag_lookup_dict.get('vpal', []):
+            if id(lookup) not in d:
+                d[id(lookup)] = self.__make_adjustments_from_lookup(lookup)
+        return d
+    
+    def __make_edge_insets_from_sums(self, placement_x, advance_x, placement_y, advance_y):
         return EdgeInsets(-placement_x, -(advance_x - placement_x), placement_y, -(advance_y + placement_y))
         
     def __make_edge_insets_dict(self):
-        d = {}
-        for tag in self.tags:
+        d = collections.defaultdict(lambda: [0, 0, 0, 0])
+        for tag in self.__tag_list:
             if tag in ('palt', 'vpal'):
-                for adjustment in self.adjustments_from_tag(tag):
-                    if adjustment.glyph not in d:
-                        d[adjustment.glyph] = []
-                    d[adjustment.glyph].append(adjustment)
-        for glyph in list(d.keys()):
-            d[glyph] = self.__make_edge_insets_from_adjustments(d[glyph])
-        return d
+                for glyph, placement, advance, direction in self.adjustments_from_tag(tag):
+                    sums = d[glyph]
+                    if direction == H:
+                        sums[0] += placement
+                        sums[1] += advance
+                    elif direction == V:
+                        sums[2] += placement
+                        sums[3] += advance
+        return dict([[glyph, self.__make_edge_insets_from_sums(*sums)] for glyph, sums in d.items()])
     
     def __make_vmtx_dict(self):
         d = {}
@@ -279,11 +349,11 @@ class CJKAlternateMetricsGPOSReader(object):
     
     @property
     def tags(self):
-        return tuple(self.__tag_list)
+        return self.__tags
     
     @property
     def has_metrics(self):
-        return 'palt' in self.tags or 'vpal' in self.tags
+        return self.__has_metrics
     
     @property
     def edge_insets(self):
@@ -300,7 +370,7 @@ class CJKAlternateMetricsGPOSReader(object):
         return self.__lookup_adjustments_dict.get(id(lookup), [])
     
     def adjustments_from_tag(self, tag):
-        return sum([self.adjustments_from_lookup(lookup) for lookup in self.lookups_from_tag(tag)], [])
+        return list(itertools.chain.from_iterable(self.adjustments_from_lookup(lookup) for lookup in self.lookups_from_tag(tag)))
     
     # - lookup parsing
     
@@ -311,69 +381,71 @@ class CJKAlternateMetricsGPOSReader(object):
                 adjustments.extend(self.__make_adjustments_from_subtable(subtable))
         return adjustments
 
-    def __make_adjustment_from_value_in_format_1(self, glyph, value):
-        return Adjustment(glyph, value.XPlacement, 0, H)
+    @staticmethod
+    def __make_adjustment_from_value_in_format_1(glyph, value):
+        return (glyph, value.XPlacement, 0, H)
         
-    def __make_adjustment_from_value_in_format_2(self, glyph, value):
-        return Adjustment(glyph, value.YPlacement, 0, V)
+    @staticmethod
+    def __make_adjustment_from_value_in_format_2(glyph, value):
+        return (glyph, value.YPlacement, 0, V)
         
-    def __make_adjustment_from_value_in_format_4(self, glyph, value):
-        return Adjustment(glyph, 0, value.XAdvance, H)
+    @staticmethod
+    def __make_adjustment_from_value_in_format_4(glyph, value):
+        return (glyph, 0, value.XAdvance, H)
     
-    def __make_adjustment_from_value_in_format_5(self, glyph, value):
-        return Adjustment(glyph, value.XPlacement, value.XAdvance, H)
+    @staticmethod
+    def __make_adjustment_from_value_in_format_5(glyph, value):
+        return (glyph, value.XPlacement, value.XAdvance, H)
     
-    def __make_adjustment_from_value_in_format_8(self, glyph, value):
-        return Adjustment(glyph, 0, value.YAdvance, V)
+    @staticmethod
+    def __make_adjustment_from_value_in_format_8(glyph, value):
+        return (glyph, 0, value.YAdvance, V)
         
-    def __make_adjustment_from_value_in_format_10(self, glyph, value):
-        return Adjustment(glyph, value.YPlacement, value.YAdvance, V)
+    @staticmethod
+    def __make_adjustment_from_value_in_format_10(glyph, value):
+        return (glyph, value.YPlacement, value.YAdvance, V)
+    
+    _VALUE_FORMAT_DISPATCH = {
+        1:  __make_adjustment_from_value_in_format_1.__func__,
+        2:  __make_adjustment_from_value_in_format_2.__func__,
+        4:  __make_adjustment_from_value_in_format_4.__func__,
+        5:  __make_adjustment_from_value_in_format_5.__func__,
+        8:  __make_adjustment_from_value_in_format_8.__func__,
+        10: __make_adjustment_from_value_in_format_10.__func__,
+    }
     
     def __make_adjustments_from_subtable(self, subtable):
-        adjustments = []
-        if subtable.Format in [1, 2]:
-            make_adjustment_from_value = {
-                1:  self.__make_adjustment_from_value_in_format_1,
-                2:  self.__make_adjustment_from_value_in_format_2,
-                4:  self.__make_adjustment_from_value_in_format_4,
-                5:  self.__make_adjustment_from_value_in_format_5,
-                8:  self.__make_adjustment_from_value_in_format_8,
-                10: self.__make_adjustment_from_value_in_format_10,
-            }.get(subtable.ValueFormat)
-            if make_adjustment_from_value:
-                glyphs = [str(glyph) for glyph in subtable.Coverage.glyphs]
-                values = self.__ensure_enumerable(subtable.Value)
-                if len(glyphs) == len(values):
-                    for i, value in enumerate(self.__ensure_enumerable(subtable.Value)):
-                        adjustments.append(make_adjustment_from_value(glyphs[i], value))
-                elif len(values) == 1:
-                    value = values[-1]
-                    for glyph in glyphs:
-                        adjustments.append(make_adjustment_from_value(glyph, value))
-        return adjustments
+        if subtable.Format not in [1, 2]:
+            return []
+        make_adjustment_from_value = self._VALUE_FORMAT_DISPATCH.get(subtable.ValueFormat)
+        if make_adjustment_from_value is None:
+            return []
+        glyphs = [str(glyph) for glyph in subtable.Coverage.glyphs]
+        # format 1 holds a single ValueRecord; format 2 holds a sequence, which is a LazyList on lazily loaded fonts
+        values = [subtable.Value] if subtable.Format == 1 else subtable.Value
+        if len(glyphs) == len(values):
+            return [make_adjustment_from_value(glyph, value) for glyph, value in zip(glyphs, values)]
+        elif len(values) == 1:
+            value = values[-1]
+            return [make_adjustment_from_value(glyph, value) for glyph in glyphs]
+        return []
     
-    @staticmethod
-    def __ensure_enumerable(obj):
-        try:
-            iter(obj)
-        except TypeError:
-            return [obj]
-        return obj
-        
     # - 
     
     @staticmethod
     def test_drive_with_font_at_path(path):
         from pprint import pprint
         
-        font = TTFont(path)
+        font = TTFont(path, lazy=True)
         reader = CJKAlternateMetricsGPOSReader(font)
         
         # dump tables
         for tag in reader.tags:
+            if tag not in ('palt', 'vpal'):
+                continue
             print('{0}:'.format(tag))
             for adjustment in reader.adjustments_from_tag(tag):
-                print('    {0}'.format(str(adjustment)))
+                print('    {0}'.format(str(Adjustment(*adjustment))))
         
         # prettification
         pprint(reader.edge_insets)